@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 """
 A Flask application that:
-- Continuously captures video at 1080p.
-- Downscales frames to 720p for a live MJPEG preview.
+- Continuously captures video at 720p.
+- Streams a live 720p MJPEG preview encoded by the Pi's hardware JPEG encoder.
 - Provides a "Capture Image" button that returns a full-resolution (1080p) snapshot.
 - Implements motion detection and serves its status to the client.
 - Provides manual LED color control using preset buttons (including White).
@@ -10,26 +10,44 @@ A Flask application that:
 - Uses a centralized LED update loop to mitigate flickering.
 - Supports auto motion-based LED control (blue when motion is detected) plus a flash override when capturing.
 - Sends push notifications (via Pushover) on snapshot capture and LED changes.
-All capture is performed continuously without reconfiguring the camera.
+Snapshots briefly switch the camera to a 1080p still mode; otherwise it runs continuously at 720p.
 """
 
+import io
 import os
 import time
 import threading
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from flask import Flask, render_template, Response, send_file, jsonify, request
 from picamera2 import Picamera2
+from picamera2.encoders import MJPEGEncoder
+from picamera2.outputs import FileOutput
 import cv2
 import numpy as np
 
 app = Flask(__name__)
 
+# Background workers for push notifications and snapshot writes, so request threads never wait on network or disk I/O.
+BACKGROUND_WORKERS = 4
+background_pool = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS)
+
 # --- Pushover Notification Setup ---
 PUSHOVER_USER_KEY = "Use your user key from pushover"   
 PUSHOVER_API_TOKEN = "Use your api token from pushover"    
 
+# Reuse keep-alive connections to Pushover instead of a new TLS handshake per notification.
+# The pool holds one connection per background worker so concurrent posts never discard a connection.
+pushover_session = requests.Session()
+pushover_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=BACKGROUND_WORKERS))
+
 def send_push_notification(message, title="Pi Cam Notification", priority=0):
+    """Queue a push notification on the background pool and return immediately."""
+    background_pool.submit(post_push_notification, message, title, priority)
+
+def post_push_notification(message, title, priority):
     payload = {
         "token": PUSHOVER_API_TOKEN,
         "user": PUSHOVER_USER_KEY,
@@ -38,7 +56,7 @@ def send_push_notification(message, title="Pi Cam Notification", priority=0):
         "priority": priority
     }
     try:
-        response = requests.post("https://api.pushover.net/1/messages.json", data=payload)
+        response = pushover_session.post("https://api.pushover.net/1/messages.json", data=payload, timeout=5)
         if response.status_code != 200:
             print("Failed to send push notification:", response.text)
         else:
@@ -68,57 +86,148 @@ if not os.path.exists(CAPTURES_DIR):
     os.makedirs(CAPTURES_DIR)
 
 # --- Camera Setup ---
+class StreamingOutput(io.BufferedIOBase):
+    """Keep the most recent JPEG produced by the hardware MJPEG encoder and wake waiting clients."""
+    def __init__(self):
+        self.frame = None
+        self.condition = threading.Condition()
+
+    def write(self, buf):
+        with self.condition:
+            self.frame = buf
+            self.condition.notify_all()
+
+mjpeg_output = StreamingOutput()
+
 picam2 = Picamera2()
-config = picam2.create_preview_configuration(main={"format": "XRGB8888", "size": (1920, 1080)})
+# The lores YUV420 stream provides a small luma (Y) plane for motion detection straight from the ISP.
+MOTION_SIZE = (320, 240)
+# The main stream runs at the 720p preview size; 1080p is only captured on demand for snapshots.
+config = picam2.create_video_configuration(main={"format": "XRGB8888", "size": (1280, 720)},
+                                           lores={"format": "YUV420", "size": MOTION_SIZE})
+# Still mode keeps the lores stream so the capture thread's pending capture_array("lores") still succeeds
+# while the camera is in still mode (those frames are discarded by motion detection).
+still_config = picam2.create_still_configuration(main={"format": "XRGB8888", "size": (1920, 1080)},
+                                                 lores={"format": "YUV420", "size": MOTION_SIZE})
 picam2.configure(config)
-picam2.start()
+# The main stream is JPEG-encoded in hardware (V4L2), so the CPU does no resize/encode for the preview.
+mjpeg_encoder = MJPEGEncoder()
+picam2.start_recording(mjpeg_encoder, FileOutput(mjpeg_output))
 time.sleep(2)  # Allow auto-exposure and white balance to settle.
 
-# Global variable for the full-resolution frame.
-latest_frame_full = None
-frame_lock = threading.Lock()
+snapshot_lock = threading.Lock()
+# Bumped before and after every snapshot mode switch (odd while a switch is in progress). The still mode uses a
+# different sensor mode, field of view and exposure, so motion detection discards frames and history across it.
+camera_mode_generation = 0
+
+def capture_still():
+    """
+    Capture a 1080p frame by briefly switching the camera to the still configuration.
+    The MJPEG encoder is paused during the switch, since it is set up for the 720p main stream.
+    """
+    global camera_mode_generation
+    with snapshot_lock:
+        try:
+            # Inside the try so the finally always restores even parity, even if stop_encoder() raises.
+            camera_mode_generation += 1
+            picam2.stop_encoder()
+            return picam2.switch_mode_and_capture_array(still_config)
+        except Exception:
+            # A failed stop/switch may have left the camera stopped or in still mode; put it back in the preview mode.
+            try:
+                picam2.stop()
+                picam2.configure(config)
+                picam2.start()
+            except Exception as e:
+                print("Error restoring preview mode:", e)
+            raise
+        finally:
+            try:
+                picam2.start_encoder(mjpeg_encoder, FileOutput(mjpeg_output))
+            except Exception as e:
+                print("Error restarting MJPEG encoder:", e)
+            camera_mode_generation += 1
 
 # --- Motion Detection Variables ---
+# Buffers are allocated once at the lores size so the motion loop does no per-frame allocations.
 prev_frame_gray = None
+diff = np.empty((MOTION_SIZE[1], MOTION_SIZE[0]), np.uint8)
+thresh = np.empty_like(diff)
+# Changed-pixel masks for the latest and the previous frame pair; swapped every frame.
+motion_mask = np.empty_like(diff)
+prev_motion_mask = np.empty_like(diff)
+have_prev_mask = False
+MOTION_FRAME_STRIDE = 3  # Run motion detection on every 3rd frame (~10 Hz at 30 FPS).
 motion_detected = False
+motion_changed = threading.Event()  # Set on every motion/no-motion transition.
 
 def capture_frames():
-    """Continuously capture frames, update the preview frame, and compute motion detection."""
-    global latest_frame_full, prev_frame_gray, motion_detected
+    """Continuously capture lores frames and compute motion detection."""
+    global prev_frame_gray, motion_detected
+    global motion_mask, prev_motion_mask, have_prev_mask
+    frame_count = 0
+    seen_generation = camera_mode_generation
     while True:
         try:
-            frame = picam2.capture_array()  # Capture a 1080p frame.
-            with frame_lock:
-                latest_frame_full = frame.copy()
-            # Compute motion detection.
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            generation = camera_mode_generation
+            lores = picam2.capture_array("lores")  # Lores YUV420 frame.
+            if generation % 2 or generation != camera_mode_generation:
+                continue  # Captured during a snapshot mode switch.
+            if generation != seen_generation:
+                # First frame after a snapshot: start the motion history over.
+                seen_generation = generation
+                prev_frame_gray = None
+                have_prev_mask = False
+            frame_count += 1
+            if frame_count % MOTION_FRAME_STRIDE:
+                continue
+            # Compute motion detection on the Y plane of the lores frame.
+            gray = lores[:MOTION_SIZE[1], :MOTION_SIZE[0]]
             if prev_frame_gray is not None:
-                diff = cv2.absdiff(gray, prev_frame_gray)
-                thresh = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)[1]
-                non_zero_count = np.count_nonzero(thresh)
-                motion_detected = non_zero_count > 5000  # Adjust threshold if needed.
-            prev_frame_gray = gray.copy()
+                cv2.absdiff(gray, prev_frame_gray, dst=diff)
+                cv2.compare(diff, 25, cv2.CMP_GT, dst=motion_mask)
+                if have_prev_mask:
+                    # Three-frame difference: only pixels that changed across both of the last two frame pairs
+                    # count. This suppresses step changes (e.g. a light switched on and left on) and uncorrelated
+                    # per-pixel noise; a one-frame flash still passes, since it differs from the frames on both sides.
+                    # A moving object scores about half of what a single diff gives, so the threshold is halved too.
+                    non_zero_count = cv2.countNonZero(cv2.bitwise_and(motion_mask, prev_motion_mask, dst=thresh))
+                    detected = non_zero_count > 92  # Adjust threshold if needed (5000 px at 1080p, scaled to lores, halved for the AND).
+                    if detected != motion_detected:
+                        motion_detected = detected
+                        motion_changed.set()
+                motion_mask, prev_motion_mask = prev_motion_mask, motion_mask
+                have_prev_mask = True
+            # capture_array() returns a freshly allocated array, so keeping a reference is enough.
+            prev_frame_gray = gray
         except Exception as e:
             print("Error capturing frame:", e)
-        time.sleep(0.03)
+            time.sleep(0.03)
 
 # Start the capture thread.
 threading.Thread(target=capture_frames, daemon=True).start()
 
+# Multipart boundary framing around each MJPEG frame, built once.
+MJPEG_FRAME_HEAD = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
+MJPEG_FRAME_TAIL = b"\r\n"
+
 def gen_video_stream():
-    """Generate MJPEG stream by downscaling the full-resolution frame to 720p."""
-    global latest_frame_full
+    """
+    Generate MJPEG stream from the JPEG frames produced by the hardware encoder.
+    Every client shares the same encoded frame and always gets the newest one; stale frames are skipped.
+    """
     while True:
-        with frame_lock:
-            if latest_frame_full is None:
-                continue
-            frame_720 = cv2.resize(latest_frame_full, (1280, 720))
-            ret, jpeg = cv2.imencode(".jpg", frame_720)
-            if not ret:
+        with mjpeg_output.condition:
+            # Time out so the thread is not parked forever while the encoder is paused (e.g. during a snapshot).
+            if not mjpeg_output.condition.wait(timeout=1):
                 continue
-            frame_bytes = jpeg.tobytes()
-        yield (b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + frame_bytes + b"\r\n")
-        time.sleep(0.03)
+            frame_bytes = mjpeg_output.frame
+        if frame_bytes is None:
+            continue
+        # Yield the pieces separately so the JPEG payload is not copied into a new bytes object.
+        yield MJPEG_FRAME_HEAD
+        yield frame_bytes
+        yield MJPEG_FRAME_TAIL
 
 # --- LED PWM Setup ---
 from gpiozero import PWMLED
@@ -147,28 +256,36 @@ def set_led_color(r, g, b):
     blue_led.value = blue_out
 
 # --- Centralized LED Update Handling ---
-led_lock = threading.Lock()
+# led_target (a tuple) and flash_override_end (a float) are each replaced by a single reference assignment,
+# which is atomic under the GIL, and neither depends on the other, so no lock is needed.
 led_target = (0, 0, 0)
 flash_override_end = 0
+led_changed = threading.Event()  # Set whenever the LED target or flash override changes.
 
 def set_led_target(new_color):
-    """Safely update the LED target color."""
+    """Update the LED target color and wake the LED update loop."""
     global led_target
-    with led_lock:
-        led_target = new_color
+    led_target = new_color
+    led_changed.set()
 
 def led_update_loop():
-    """Update the LED output every 100ms based on flash override and target color."""
+    """Update the LED output whenever the target color or flash override changes."""
     global led_target, flash_override_end
+    last_written = None
     while True:
+        led_changed.clear()
         now = time.time()
-        with led_lock:
-            if now < flash_override_end:
-                desired = (1, 1, 1)  # Flash override: white.
-            else:
-                desired = led_target
-        set_led_color(*desired)
-        time.sleep(0.1)
+        timeout = None
+        if now < flash_override_end:
+            desired = (1, 1, 1)  # Flash override: white.
+            timeout = flash_override_end - now  # Wake up again when the flash ends.
+        else:
+            desired = led_target
+        # Only touch the GPIO pins when the output actually changes.
+        if desired != last_written:
+            set_led_color(*desired)
+            last_written = desired
+        led_changed.wait(timeout)
 
 threading.Thread(target=led_update_loop, daemon=True).start()
 
@@ -178,12 +295,15 @@ def auto_led_update():
     """If auto mode is enabled, update the LED target based on motion detection (blue for motion, off otherwise)."""
     global motion_led_auto
     while True:
+        # Wake immediately on a motion transition, and re-apply at least once a second so a manual
+        # change (e.g. /off_led) is corrected while auto mode is on, as before.
+        motion_changed.wait(timeout=1)
+        motion_changed.clear()
         if motion_led_auto:
             if motion_detected:
                 set_led_target((0, 0, 1))
             else:
                 set_led_target((0, 0, 0))
-        time.sleep(1)
 
 threading.Thread(target=auto_led_update, daemon=True).start()
 
@@ -204,29 +324,44 @@ def video_feed():
     return Response(gen_video_stream(),
                     mimetype="multipart/x-mixed-replace; boundary=frame")
 
+SNAPSHOT_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 90]  # Built once and reused for every snapshot encode.
+
+def write_snapshot(filepath, jpeg):
+    """Write an encoded snapshot to disk."""
+    try:
+        with open(filepath, "wb") as f:
+            f.write(jpeg)
+    except Exception as e:
+        print("Error saving snapshot:", e)
+
 @app.route("/capture", methods=["POST"])
 def capture():
     """
-    Capture a snapshot from the current 1080p frame,
-    save it, and send it to the client.
+    Capture a 1080p snapshot,
+    save it in the background, and send it to the client.
     Also trigger a flash override: LED white for 2 seconds, and send a push notification.
     """
-    global latest_frame_full, flash_override_end
-    with frame_lock:
-        if latest_frame_full is None:
-            return "No frame available", 503
-        frame_to_save = latest_frame_full.copy()
+    global flash_override_end
+    try:
+        frame_to_save = capture_still()
+    except Exception as e:
+        print("Error capturing snapshot:", e)
+        return "No frame available", 503
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"capture_{timestamp}.jpg"
     filepath = os.path.join(CAPTURES_DIR, filename)
-    cv2.imwrite(filepath, frame_to_save)
-    with led_lock:
-        flash_override_end = time.time() + 2
+    # Encode once: the same JPEG is written to disk in the background and returned to the client.
+    ret, jpeg = cv2.imencode(".jpg", frame_to_save, SNAPSHOT_JPEG_PARAMS)
+    if not ret:
+        return "Failed to encode snapshot", 500
+    background_pool.submit(write_snapshot, filepath, jpeg)
+    flash_override_end = time.time() + 2
+    led_changed.set()
     color_name = get_led_color_name(led_target)
     auto_status = "Enabled" if motion_led_auto else "Disabled"
     send_push_notification(f"Snapshot captured at {timestamp}.\nLED: {color_name}\nAuto LED: {auto_status}",
                            title="Pi Cam Snapshot")
-    return send_file(filepath, as_attachment=True)
+    return send_file(io.BytesIO(jpeg), mimetype="image/jpeg", as_attachment=True, download_name=filename)
 
 @app.route("/motion_status")
 def motion_status():
@@ -259,6 +394,7 @@ def toggle_motion_led():
     """Toggle auto motion-based LED control on or off."""
     global motion_led_auto
     motion_led_auto = not motion_led_auto
+    motion_changed.set()  # Apply the current motion state right away when auto mode is re-enabled.
     return jsonify(motion_led_auto=motion_led_auto)
 
 if __name__ == "__main__":